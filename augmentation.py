@@ -97,7 +97,7 @@ def get_segments(graph, img_origin, img_label):
     for idx, item in enumerate(graph_edges):
         path = item[2]['path']
         for p in path:
-            img_graph[p] = idx
+            img_graph[tuple(p)] = idx
 
     _, (img_inds_r, img_inds_c) = ndi.distance_transform_edt(img_graph==-1, 
                                                              return_indices=True)
@@ -366,7 +366,7 @@ def create_image(img_origin, img_label, rqi_len_interv, min_len_interv,
         img_seg = img_segs==edge_index
 
         # Initial and final points of augmented region
-        pc_idx = edge_path.index(pc)
+        pc_idx = np.flatnonzero((edge_path==pc).all(axis=1))[0]
         p1_idx , p2_idx = point_from_dist(edge_path, pc_idx, rqi_len//2)
         p1 = edge_path[p1_idx]
         p2 = edge_path[p2_idx]
@@ -375,7 +375,7 @@ def create_image(img_origin, img_label, rqi_len_interv, min_len_interv,
 
         img_skel = np.zeros(img_label.shape, dtype=np.uint8)
         for point in skel_aug_points:
-            img_skel[point] = 128
+            img_skel[tuple(point)] = 128
 
         img_aug_crop = get_crop(img_aug, pc, rqi_len).copy()
         img_label_crop = get_crop(img_label, pc, rqi_len)
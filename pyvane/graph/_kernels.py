@@ -0,0 +1,116 @@
+"""Compiled kernels used by the graph modules. The kernels are cached on disk by numba, so that they
+are compiled only once. If numba is not available, `njit` does nothing and the functions run as regular
+Python code."""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    print('numba not found, graph functions will not be compiled.')
+
+    def njit(*args, **kwargs):
+        """Replacement for numba.njit when numba is not available. The decorated
+        function is returned unchanged."""
+
+        if len(args)==1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+    prange = range
+
+@njit(cache=True)
+def track_branch_nb(num_neighbors_flat, first_point, offsets):
+    """Track a branch starting at pixel `first_point` of the raveled neighborhood image, stopping
+    when finding another termination or bifurcation. All pixels in the path have two neighbors. The
+    image must be padded with background values, so that no bounds check is needed. Returns the
+    linear indices of the path."""
+
+    path = np.empty(16, dtype=np.int64)
+    path[0] = first_point
+    size = 1
+
+    # The second point is the last neighbor having two neighbors
+    curr_point = -1
+    for offset in offsets:
+        if num_neighbors_flat[first_point+offset]==2:
+            curr_point = first_point + offset
+
+    prev_point = first_point
+    while curr_point!=-1:
+        if size==path.size:
+            new_path = np.empty(2*size, dtype=np.int64)
+            new_path[:size] = path
+            path = new_path
+        path[size] = curr_point
+        size += 1
+
+        # Find the first neighbor with value 2 that is not the previous point
+        next_point = -1
+        for offset in offsets:
+            neighbor = curr_point + offset
+            if (num_neighbors_flat[neighbor]==2) and (neighbor!=prev_point):
+                next_point = neighbor
+                break
+        prev_point = curr_point
+        curr_point = next_point
+
+    return path[:size]
+
+@njit(parallel=True, cache=True)
+def track_branches_nb(num_neighbors_flat, offsets, branch_bounds, branches_lin, branch_keys, branch_ip_ids):
+    """Track the branches of all interest points. See `pyvane.graph.creation.track_branches`. The
+    branches of point i are given by branches_lin[branch_bounds[i]:branch_bounds[i+1]]. Arrays
+    `branch_keys` and `branch_ip_ids` are the branch table of a BranchMap.
+
+    Returns the indices of the points connected by each edge, the bounds of each path and the linear
+    indices of all paths concatenated."""
+
+    num_ips = branch_bounds.size - 1
+    num_branches = branches_lin.size
+
+    # Path starting at each branch. Paths are independent, so they are tracked in parallel, each
+    # one written to its own slot of the list
+    branch_paths = [np.empty(0, dtype=np.int64) for _ in range(num_branches)]
+    for branch_idx in prange(num_branches):
+        branch_paths[branch_idx] = track_branch_nb(num_neighbors_flat, branches_lin[branch_idx], offsets)
+
+    # Select the branches that generate edges. A path is not kept again when starting from its last
+    # pixel. This depends on the order of the points, so it is done serially
+    visited = np.zeros(num_neighbors_flat.size, dtype=np.uint8)    # Indexed by the linear index of a pixel
+    edge_branches = np.empty(num_branches, dtype=np.int64)
+    ip_ids = np.empty((num_branches, 2), dtype=np.int64)
+    path_bounds = np.zeros(num_branches+1, dtype=np.int64)
+    num_edges = 0
+    for ip1_idx in range(num_ips):
+        for branch_idx in range(branch_bounds[ip1_idx], branch_bounds[ip1_idx+1]):
+            branch = branches_lin[branch_idx]
+            if visited[branch]:
+                continue
+
+            path = branch_paths[branch_idx]
+            path_end = path[-1]
+            visited[branch] = 1
+            visited[path_end] = 1
+
+            last_pos = np.searchsorted(branch_keys, path_end)
+            if last_pos==branch_keys.size or branch_keys[last_pos]!=path_end:
+                raise ValueError('The last pixel of a path is not a branch of an interest point')
+            last_pos_end = np.searchsorted(branch_keys, path_end, side='right')
+            ip2_idx = branch_ip_ids[last_pos]
+            if last_pos_end-last_pos==2 and ip2_idx==ip1_idx:
+                # If branch is a single point between two bifurcations
+                ip2_idx = branch_ip_ids[last_pos+1]
+
+            edge_branches[num_edges] = branch_idx
+            ip_ids[num_edges, 0] = ip1_idx
+            ip_ids[num_edges, 1] = ip2_idx
+            path_bounds[num_edges+1] = path_bounds[num_edges] + path.size
+            num_edges += 1
+
+    # Copy the selected paths to the output
+    paths = np.empty(path_bounds[num_edges], dtype=np.int64)
+    for edge_idx in prange(num_edges):
+        paths[path_bounds[edge_idx]:path_bounds[edge_idx+1]] = branch_paths[edge_branches[edge_idx]]
+
+    return ip_ids[:num_edges], path_bounds[:num_edges+1], paths
@@ -1,12 +1,15 @@
 """Module for changing the topology of a graph created by pyvane.graph.creation. Some heuristics
 are used for simplifying the graph and removing small edges."""
 
-from skimage import draw
+import heapq
+import itertools
+import math
 import networkx as nx
 import numpy as np
 import pyvane.util as util
+from pyvane.graph._kernels import njit, prange
 
-def simplify(graph, use_old_method=False, verbose=False):
+def simplify(graph, verbose=False):
     """Simplify node positions in a graph, also adjusting the edges. It is assumed that nodes in the
     graph have an attribute 'pixels' containing a list of pixel positions and an attribute 'center',
     containing a single pixel coordinate indicating the position of the node. Also, the edges must have
@@ -68,72 +71,127 @@ def simplify(graph, use_old_method=False, verbose=False):
         num_edges = graph.number_of_edges()
         print_interv = util.get_print_interval(num_edges)
 
-    graph_simple = graph.copy()
+    # Node centers and the first and last pixels of the edge paths are gathered into arrays, so
+    # that the line segments connecting the paths to the node centers can be drawn in a single batch.
+    node_index = {node:idx for idx, node in enumerate(graph.nodes)}
+    centers = np.array([center for _, center in graph.nodes(data='center')], dtype=np.int64).reshape(-1, ndim)
+    is_single_pixel = np.array([len(pixels)==1 for _, pixels in graph.nodes(data='pixels')], dtype=bool)
+
+    edges = list(graph.edges(keys=True, data=True))
+    node1_idxs = np.array([node_index[edge[0]] for edge in edges], dtype=np.int64)
+    node2_idxs = np.array([node_index[edge[1]] for edge in edges], dtype=np.int64)
+    first_pixels = np.array([edge[3]['path'][0] for edge in edges], dtype=np.int64).reshape(-1, ndim)
+    last_pixels = np.array([edge[3]['path'][-1] for edge in edges], dtype=np.int64).reshape(-1, ndim)
+
+    # Segment 2*i goes from node1 to the first pixel of the path of edge i and segment 2*i+1 goes
+    # from the last pixel of the path to node2. If a node has only one pixel, no need to simplify,
+    # and the segment is represented by identical end points.
+    starts = np.empty((2*len(edges), ndim), dtype=np.int64)
+    ends = np.empty((2*len(edges), ndim), dtype=np.int64)
+    starts[0::2] = np.where(is_single_pixel[node1_idxs][:, None], first_pixels, centers[node1_idxs])
+    ends[0::2] = first_pixels
+    starts[1::2] = last_pixels
+    ends[1::2] = np.where(is_single_pixel[node2_idxs][:, None], last_pixels, centers[node2_idxs])
+
+    lines, offsets = _draw_segments(starts, ends)
+
+    # The new graph is built directly with the new paths, instead of copying the input graph and
+    # then replacing the paths of all edges
+    graph_simple = nx.MultiGraph()
+    graph_simple.graph.update(graph.graph)
+    graph_simple.add_nodes_from(graph.nodes(data=True))
 
     new_edges = []
-    for edge_idx, (node1_idx, node2_idx, key, path) in enumerate(graph_simple.edges(data='path', keys=True)):
+    for edge_idx, (node1_idx, node2_idx, key, edge_attrs) in enumerate(edges):
 
         if verbose:
             if edge_idx%print_interv==0 or edge_idx==num_edges-1:
                 print(f'\rSimplifying edge {edge_idx+1} of {num_edges}', end='')
 
-        node1 = graph.nodes[node1_idx]
-        node2 = graph.nodes[node2_idx]
+        node1_to_path_line = lines[offsets[2*edge_idx]:offsets[2*edge_idx+1]]
+        path_to_node2_line = lines[offsets[2*edge_idx+1]:offsets[2*edge_idx+2]]
 
-        if len(node1['pixels'])==1:
-            # If node has only one pixel, no need to simplify
-            node1_to_path_line = []
-        else:
-            if use_old_method:
-                node1_to_path_line = draw_line_nd_old(node1['center'], path[0])
-            else:
-                node1_to_path_line = draw.line_nd(node1['center'], path[0], endpoint=False)
-            # Remove starting point, which is the same as node1.center
-            node1_to_path_line = tuple(coord[1:] for coord in node1_to_path_line)
+        new_path = np.concatenate((node1_to_path_line, edge_attrs['path'], path_to_node2_line), dtype=np.int32)
 
-        if len(node2['pixels'])==1:
-            # If node has only one pixel, no need to simplify
-            path_to_node2_line = []
-        else:
-            if use_old_method:
-                path_to_node2_line = draw_line_nd_old(path[-1], node2['center'])
-            else:
-                path_to_node2_line = draw.line_nd(path[-1], node2['center'], endpoint=False)
-            # Remove starting point, which is the same as node1.center
-            path_to_node2_line = tuple(coord[1:] for coord in path_to_node2_line)
+        new_edges.append((node1_idx, node2_idx, key, {**edge_attrs, 'path':new_path}))
 
-        new_path = list(zip(*node1_to_path_line)) + path + list(zip(*path_to_node2_line))
-
-        graph_simple[node1_idx][node2_idx][key]['path'] = new_path
+    graph_simple.add_edges_from(new_edges)
 
     return graph_simple
 
-def draw_line_nd_old(p1, p2):
-    """Old an extremely inefficient approach for drawing a line. Do not use."""
-
-    p1, p2 = np.array(p1), np.array(p2)
-    vet = p2 - p1
-    t = np.linspace(0, 1, 1000)
-    seg = p1 + vet*np.array([t]).T
-    seg = np.round(seg).astype(np.int)
+def _draw_segments(starts, ends):
+    """Draw many line segments at once. The starting pixel of each segment is not included in
+    the segment, and neither is the final pixel. The segments are stored contiguously in a single
+    array.
 
-    new_seg = [seg[0]]
-    for j in range(1,len(seg)):
-        #if ((seg[j][0] != seg[j-1][0]) | (seg[j][1] <> seg[j-1][1]) | (seg[j][2] <> seg[j-1][2])):
-        if tuple(seg[j])!=tuple(seg[j-1]):
-            new_seg.append(seg[j])
+    Parameters
+    ----------
+    starts : ndarray
+        Array of shape (num_segments, ndim) containing the start point of each segment.
+    ends : ndarray
+        Array of shape (num_segments, ndim) containing the end point of each segment.
 
-    new_seg.pop(-1)
+    Returns
+    -------
+    lines : ndarray
+        Array of shape (num_pixels, ndim) containing the pixels of all segments.
+    offsets : ndarray
+        The pixels of segment i are given by lines[offsets[i]:offsets[i+1]].
+    """
 
-    return tuple(zip(*new_seg))
+    num_steps = np.abs(ends-starts).max(axis=1, initial=0)
+    offsets = np.zeros(len(starts)+1, dtype=np.int64)
+    np.cumsum(np.maximum(num_steps-1, 0), out=offsets[1:])
+    lines = _fill_segments(starts, ends, num_steps, offsets)
+
+    return lines, offsets
+
+@njit(cache=True, parallel=True)
+def _fill_segments(starts, ends, num_steps, offsets):
+    """Auxiliary function for `_draw_segments`. Each segment is written to its own slice of the
+    output array, so the segments can be drawn in parallel."""
+
+    lines = np.empty((offsets[-1], starts.shape[1]), dtype=np.int32)
+    for idx in prange(starts.shape[0]):
+        _fill_line(starts[idx], ends[idx], num_steps[idx], 1, lines[offsets[idx]:offsets[idx+1]])
+
+    return lines
+
+@njit(cache=True)
+def _fill_line(p1, p2, num_steps, first_point, line):
+    """Write the pixels of the line between `p1` and `p2` into `line`, skipping the first
+    `first_point` pixels. `num_steps` is the largest absolute coordinate difference between
+    `p1` and `p2`."""
+
+    num_points = first_point + line.shape[0]
+    for axis in range(p1.shape[0]):
+        delta = p2[axis] - p1[axis]
+        # The position along the axis is p1 + quot + rem/num_steps
+        quot = 0
+        rem = 0
+        for idx in range(num_points):
+            if idx>=first_point:
+                coord = p1[axis] + quot
+                # Round half to even, as done by skimage
+                if 2*rem>num_steps or (rem>0 and 2*rem==num_steps and coord%2!=0):
+                    coord += 1
+                line[idx-first_point, axis] = coord
+
+            rem += delta
+            if rem>=num_steps and num_steps>0:
+                rem -= num_steps
+                quot += 1
+            elif rem<0:
+                rem += num_steps
+                quot -= 1
 
 def path_length(path, pix_size, img_roi=None):
     """Calculate the arc-length of a parametric sequence of pixels.
 
     Parameters
     ----------
-    path : list of tuple
-        A sequence of pixels representing a path/curve.
+    path : array_like
+        Array of shape (num_pixels, ndim) representing a path/curve.
     pix_size : tuple of float
         The physical size that a pixel represents, can be a different value for each axis.
     img_roi : ndarray
@@ -145,18 +203,48 @@ def path_length(path, pix_size, img_roi=None):
         The total length of the path.
     """
 
-    dpath = np.diff(path, axis=0)*pix_size
-    dlengths = np.sqrt(np.sum(dpath**2, axis=1))
+    path_arr = np.asarray(path)
+    if img_roi is None:
+        return _path_length(path_arr, np.asarray(pix_size, dtype=np.float64))
+
+    dpath = (path_arr[1:]-path_arr[:-1])*pix_size
+    dlengths = np.sqrt(np.einsum('ij,ij->i', dpath, dpath))
 
-    if img_roi is not None:
-        is_inside_roi = img_roi[tuple(zip(*path))]==1
-        dlengths = dlengths[is_inside_roi[1:]]
+    is_inside_roi = img_roi[tuple(path_arr.astype(np.intp, copy=False).T)]==1
+    dlengths = dlengths[is_inside_roi[1:]]
 
     path_length = np.sum(dlengths)
 
     return path_length
 
-def add_length(graph):
+@njit(cache=True)
+def _path_length(path, pix_size):
+    """Calculate the arc-length of a path without creating intermediate arrays.
+
+    Parameters
+    ----------
+    path : ndarray
+        Array of shape (num_pixels, ndim) representing a path/curve.
+    pix_size : ndarray
+        The physical size that a pixel represents, can be a different value for each axis.
+
+    Returns
+    -------
+    path_length : float
+        The total length of the path.
+    """
+
+    path_length = 0.
+    for idx in range(path.shape[0]-1):
+        dlength = 0.
+        for axis in range(path.shape[1]):
+            dpath = (path[idx+1, axis]-path[idx, axis])*pix_size[axis]
+            dlength += dpath*dpath
+        path_length += np.sqrt(dlength)
+
+    return path_length
+
+def add_length(graph, pix_size=None):
     """Add arc-length information for all edges in the graph. The graph is modified in-place.
     A new attribute 'length' is added to the edges.
 
@@ -164,14 +252,34 @@ def add_length(graph):
     ----------
     graph : networkx.MultiGraph
         The input graph.
+    pix_size : ndarray, optional
+        The physical size of the pixels. If not provided, graph.graph['pix_size'] is used.
     """
 
-    pix_size = graph.graph['pix_size']
-    pix_size = np.array(pix_size)
+    if pix_size is None:
+        pix_size = np.array(graph.graph['pix_size'], dtype=np.float64)
 
-    for node1, node2, key, path in graph.edges(data='path', keys=True):
+    edges_attrs = [edge_attrs for _, _, edge_attrs in graph.edges(data=True)]
+    if len(edges_attrs)==0:
+        return
+
+    # The paths of all edges are stacked and the lengths of all segments between consecutive pixels
+    # are calculated at once. Segments connecting the last pixel of a path to the first pixel of the
+    # next path are set to zero, so that the length of each edge can be obtained by summing the
+    # segments inside the range of its path.
+    paths = [edge_attrs['path'] for edge_attrs in edges_attrs]
+    path_sizes = np.array([len(path) for path in paths])
+    path_starts = np.concatenate(([0], np.cumsum(path_sizes)[:-1]))
+    all_pixels = np.concatenate(paths)
 
-        graph[node1][node2][key]['length'] = path_length(path, pix_size)
+    dpath = np.diff(all_pixels, axis=0)*pix_size
+    dlengths = np.zeros(len(all_pixels))
+    dlengths[:-1] = np.sqrt(np.einsum('ij,ij->i', dpath, dpath))
+    dlengths[path_starts[1:]-1] = 0
+    lengths = np.add.reduceat(dlengths, path_starts)
+
+    for edge_attrs, length in zip(edges_attrs, lengths.tolist()):
+        edge_attrs['length'] = length
 
 def add_branch_info(graph):
     """Add branchness information for all edges in the graph. If an edge is incident on at least one
@@ -184,12 +292,9 @@ def add_branch_info(graph):
         The input graph.
     """
 
-    for node1, node2, key in graph.edges(keys=True):
-
-        if graph.degree(node1)==1 or graph.degree(node2)==1:
-            graph[node1][node2][key]['is_branch'] = True
-        else:
-            graph[node1][node2][key]['is_branch'] = False
+    terminations = {node for node, degree in graph.degree() if degree==1}
+    for node1, node2, edge_attrs in graph.edges(data=True):
+        edge_attrs['is_branch'] = node1 in terminations or node2 in terminations
 
 def multiedge_iter(graph):
     """Generator for edges that are multiple in the graph, that is, edges connecting pairs of
@@ -209,13 +314,14 @@ def multiedge_iter(graph):
         are edge attributes.
     """
 
-    multiple_edges = set()
-    for node1, node2, _ in graph.edges:
-        if len(graph[node1][node2])>1:
-            multiple_edges.add((node1, node2))
-
-    for edge in multiple_edges:
-        yield (edge[0], edge[1], graph[edge[0]][edge[1]])
+    # The adjacency dictionary is scanned directly. Each pair of nodes is reported once, when the
+    # first node of the pair is visited. The graph must not be modified during the iteration.
+    visited = set()
+    for node1, neighbors in graph._adj.items():
+        for node2, edges in neighbors.items():
+            if node2 not in visited and len(edges)>1:
+                yield (node1, node2, edges)
+        visited.add(node1)
 
 def is_multiple_edge(graph, u, v):
     """Check if two nodes have multiple edges between them.
@@ -256,84 +362,163 @@ def count_multiple_edges(graph):
     edge_count = {}
     for node1, node2, _ in graph.edges:
         edge = (node1, node2)
-        if edge in edge_count:
-            edge_count[edge] += 1
-        else:
-            edge_count[edge] = 0
+        edge_count[edge] = edge_count.get(edge, -1) + 1
 
     return edge_count
 
-def argmin(values):
-    """Return the index of the smallest value of a list.
+def get_single_neighbor(graph, node):
+    """Return a neighbor of a node. Useful when the node only has one neighbor.
+
+    Parameters
+    ----------
+    graph : networkx.MultiGraph
+        The input graph.
+    node : hashable
+        The node whose neighbor will be returned.
+
+    Returns
+    -------
+    hashable
+        The neighbor node.
+    """
+
+    return list(graph[node].keys())[0]
+
+def get_single_edge_key(graph, node1, node2):
+    """Return the key of an edge between two nodes. Useful when the nodes are connected by only one edge.
 
     Parameters
     ----------
-    values : list
-        The input list
+    graph : networkx.MultiGraph
+        The input graph.
+    node1 : hashable
+        The first node.
+    node2 : hashable
+        The second node.
 
     Returns
     -------
-    index_min : int
-        The index of the smallest value in `values`.
+    hashable
+        The edge key.
     """
 
-    index_min = min(range(len(values)), key=values.__getitem__)
-    return index_min
+    return list(graph[node1][node2].keys())[0]
 
-def argmax(values):
-    """Return the index of the largest value of a list.
+def _degree(adj, node):
+    """Return the degree of a node in a MultiGraph. This is the same as graph.degree(node), but
+    reading the adjacency dictionary of the graph (graph._adj) directly, which is much faster when
+    called many times. As in networkx, self-loops are counted twice.
 
     Parameters
     ----------
-    values : list
-        The input list
+    adj : dict
+        The adjacency dictionary of the graph.
+    node : hashable
+        The input node.
 
     Returns
     -------
-    index_max : int
-        The index of the largest value in `values`.
+    int
+        The degree of the node.
     """
 
-    index_max = max(range(len(values)), key=values.__getitem__)
-    return index_max
+    neighbors = adj[node]
+    degree = sum(map(len, neighbors.values()))
+    if node in neighbors:
+        degree += len(neighbors[node])
 
-def get_single_neighbor(graph, node):
-    """Return a neighbor of a node. Useful when the node only has one neighbor.
+    return degree
+
+def _cached_degree(adj, degrees, node):
+    """Return the degree of a node, reading it from `degrees` if available. Otherwise, the degree
+    is calculated from the adjacency dictionary and stored in `degrees`. The caller is responsible for
+    updating `degrees` when edges are added or removed from the graph.
 
     Parameters
     ----------
-    graph : networkx.MultiGraph
-        The input graph.
+    adj : dict
+        The adjacency dictionary of the graph.
+    degrees : dict
+        Cache of node degrees.
     node : hashable
-        The node whose neighbor will be returned.
+        The input node.
 
     Returns
     -------
-    hashable
-        The neighbor node.
+    int
+        The degree of the node.
     """
 
-    return list(graph[node].keys())[0]
+    degree = degrees.get(node)
+    if degree is None:
+        degree = _degree(adj, node)
+        degrees[node] = degree
 
-def get_single_edge_key(graph, node1, node2):
-    """Return the key of an edge between two nodes. Useful when the nodes are connected by only one edge.
+    return degree
+
+def _remove_multi_edge(adj, node1, node2, key):
+    """Remove an edge from a MultiGraph by changing its adjacency dictionary (graph._adj) directly.
+    This avoids the overhead of graph.remove_edge, but the edge must exist in the graph. The caller
+    must call nx._clear_cache(graph) after changing the graph.
 
     Parameters
     ----------
-    graph : networkx.MultiGraph
-        The input graph.
+    adj : dict
+        The adjacency dictionary of the graph.
     node1 : hashable
-        The first node.
+        The first node of the edge.
     node2 : hashable
-        The second node.
+        The second node of the edge.
+    key : hashable
+        The key of the edge.
+    """
+
+    # In a MultiGraph, adj[node1][node2] and adj[node2][node1] are the same dictionary
+    edges = adj[node1][node2]
+    del edges[key]
+    if len(edges)==0:
+        del adj[node1][node2]
+        if node1!=node2:
+            del adj[node2][node1]
+
+def _add_multi_edge(adj, node1, node2, attrs):
+    """Add an edge to a MultiGraph by changing its adjacency dictionary (graph._adj) directly.
+    This avoids the overhead of graph.add_edge, but both nodes must already be in the graph. The
+    key of the new edge is chosen in the same way as in networkx. The caller must call
+    nx._clear_cache(graph) after changing the graph.
+
+    Parameters
+    ----------
+    adj : dict
+        The adjacency dictionary of the graph.
+    node1 : hashable
+        The first node of the edge.
+    node2 : hashable
+        The second node of the edge.
+    attrs : dict
+        The attributes of the edge. The dictionary is stored in the graph without being copied.
 
     Returns
     -------
-    hashable
-        The edge key.
+    key : int
+        The key of the new edge.
     """
 
-    return list(graph[node1][node2].keys())[0]
+    neighbors = adj[node1]
+    if node2 in neighbors:
+        edges = neighbors[node2]
+        key = len(edges)
+        while key in edges:
+            key += 1
+    else:
+        # The same dictionary is used for both directions of the edge
+        edges = {}
+        key = 0
+        neighbors[node2] = edges
+        adj[node2][node1] = edges
+    edges[key] = attrs
+
+    return key
 
 def degree_two_node_type(graph, node):
     """Return the type of a node having degree two. Possible types are
@@ -387,8 +572,9 @@ def degree_two_iter(graph, self_loops=True, multiple=True):
         A node with degree two.
     """
 
-    for node, neighbors in graph.adj.items():
-        if graph.degree(node)==2:
+    adj = graph._adj
+    for node in adj:
+        if _degree(adj, node)==2:
             node_type = degree_two_node_type(graph, node)
             if node_type=='simple':
                 yield node
@@ -397,24 +583,6 @@ def degree_two_iter(graph, self_loops=True, multiple=True):
             if node_type=='multiple' and multiple:
                 yield node
 
-def remove_if_in_list(values, item):
-    """Remove `item` in list `values`. Nothing is done if the element is not in the list.  This
-    function just calls values.remove(item) while avoiding an exception in case the element is
-    not in the list.
-
-    Parameters
-    ----------
-    values : list
-        The input list.
-    item : Object
-        The item to be removed.
-    """
-
-    try:
-        values.remove(item)
-    except ValueError:
-        pass
-
 def remove_small_mul(graph, node1, node2, length_threshold):
     """Remove the *smallest* edge between a pair of nodes having more than one edge between them. The
     edge is not removed if its length is larger than or equal to `length_threshold`.
@@ -439,12 +607,10 @@ def remove_small_mul(graph, node1, node2, length_threshold):
         Indicates if an edge was removed (True) or not (False).
     """
 
-    edges_length = map(lambda x:(x[0], x[1]['length']), graph[node1][node2].items())
-    keys, lengths = zip(*edges_length)
-    ind_smal_edge = argmin(lengths)
-    smallest_length = lengths[ind_smal_edge]
-    key_smal_edge = keys[ind_smal_edge]
-    if smallest_length<length_threshold:
+    # Scan the edge dictionary directly instead of building intermediate lists of keys and lengths
+    edges = graph._adj[node1][node2]
+    key_smal_edge = min(edges, key=lambda key: edges[key]['length'])
+    if edges[key_smal_edge]['length']<length_threshold:
         graph.remove_edge(node1, node2, key_smal_edge)
         was_removed = True
     else:
@@ -481,11 +647,7 @@ def remove_small_mul_all(graph, length_threshold):
     edges_to_remove = []
     for node1, node2, edges in multiedge_iter(graph):
 
-        edges_length = map(lambda x:(x[0], x[1]['length']), edges.items())
-        keys, lengths = zip(*edges_length)
-        ind_larg_edge = argmax(lengths)
-        largest_length = lengths[ind_larg_edge]
-        key_larg_edge = keys[ind_larg_edge]
+        key_larg_edge = max(edges, key=lambda key: edges[key]['length'])
         for key, edge_attrs in edges.items():
             edge_length = edge_attrs['length']
             if edge_length<length_threshold and key!=key_larg_edge:
@@ -551,15 +713,97 @@ def remove_small_graph_components(graph, length_threshold=20):
 
     edges_to_remove = []
     for comp in nx.connected_components(graph):
-        subgraph = graph.subgraph(comp)
-        comp_length = sum(nx.get_edge_attributes(subgraph, 'length').values())
-        if comp_length<length_threshold:
-            edges_to_remove.extend(subgraph.edges())
+        # Edges and lengths of the component are read in a single pass, without creating a subgraph.
+        # Since lengths are non-negative, the sum can stop as soon as the threshold is reached
+        comp_edges = []
+        comp_length = 0
+        for node1, node2, key, length in graph.edges(comp, keys=True, data='length'):
+            comp_length += length
+            if comp_length>=length_threshold:
+                break
+            comp_edges.append((node1, node2, key))
+        else:
+            edges_to_remove.extend(comp_edges)
 
     graph.remove_edges_from(edges_to_remove)
 
 
-def make_new_path(graph, edge1, edge2):
+def _joining_length(last_pixel, center, first_pixel, pix_size):
+    """Calculate the length of the two segments last_pixel -> center -> first_pixel that join
+    the paths of two edges through the center of the node between them.
+
+    Parameters
+    ----------
+    last_pixel : ndarray
+        Last pixel of the path arriving at the node.
+    center : tuple of int
+        Center of the node.
+    first_pixel : ndarray
+        First pixel of the path leaving the node.
+    pix_size : ndarray
+        The physical size of the pixels.
+
+    Returns
+    -------
+    float
+        The length of the two segments.
+    """
+
+    return _segment_length(last_pixel, center, pix_size) + _segment_length(center, first_pixel, pix_size)
+
+def _segment_length(pixel1, pixel2, pix_size):
+    """Calculate the length of the segment between two pixels. The floating point calculation is
+    skipped if the pixels are the same, which happens when a path already contains the center of
+    the node.
+
+    Parameters
+    ----------
+    pixel1 : array_like
+        The first pixel.
+    pixel2 : array_like
+        The second pixel.
+    pix_size : ndarray
+        The physical size of the pixels.
+
+    Returns
+    -------
+    float
+        The length of the segment.
+    """
+
+    pixel1 = tuple(pixel1)
+    pixel2 = tuple(pixel2)
+    if pixel1==pixel2:
+        return 0.
+
+    return math.hypot(*[(coord2-coord1)*size for coord1, coord2, size in zip(pixel1, pixel2, pix_size)])
+
+def _oriented_path(path, node_from, node_to):
+    """Return the path of an edge running from `node_from` to `node_to`. The path of an edge always
+    runs from the node with the smallest index to the node with the largest index, so the orientation
+    is given by comparing the nodes. When the path needs to be reversed, a view is returned and the
+    pixels are not copied.
+
+    Parameters
+    ----------
+    path : ndarray
+        The path of the edge between `node_from` and `node_to`.
+    node_from : hashable
+        The node where the returned path should start.
+    node_to : hashable
+        The node where the returned path should end.
+
+    Returns
+    -------
+    ndarray
+        The oriented path.
+    """
+
+    if node_from>node_to:
+        return path[::-1]
+    return path
+
+def make_new_path(graph, edge1, edge2, pix_size=None):
     """Create a new path based on two edges. The new path is a concatenation of
     edge1 path + node center + edge2 path, where node center is the position of the
     node between the two edges. Therefore, it is assumed that `edge1` and `edge2` are
@@ -573,10 +817,12 @@ def make_new_path(graph, edge1, edge2):
         Tuple of the form (node1, node2, edge key)
     edge2 : tuple of hashable
         Tuple of the form (node1, node2, edge key)
+    pix_size : ndarray, optional
+        The physical size of the pixels. If not provided, graph.graph['pix_size'] is used.
 
     Returns
     -------
-    new_path : list of tuple
+    new_path : ndarray
         New path containing the pixels of `edge1`, `'edge2' and the node center.
     length_new_path : float
         The length of the newly created path.
@@ -585,7 +831,8 @@ def make_new_path(graph, edge1, edge2):
     node, nei1, edge1_key = edge1
     node, nei2, edge2_key = edge2
 
-    pix_size = graph.graph['pix_size']
+    if pix_size is None:
+        pix_size = np.array(graph.graph['pix_size'])
     node_center = graph.nodes[node]['center']
 
     edge1_attrs = graph[node][nei1][edge1_key]
@@ -593,16 +840,19 @@ def make_new_path(graph, edge1, edge2):
     path_nei1 = edge1_attrs['path']
     path_nei2 = edge2_attrs['path']
 
-    if node<nei1:
-        # If node<nei1, path runs from node to nei1, we need to reverse that
-        path_nei1 = path_nei1[::-1]
-    if node>nei2:
-        path_nei2 = path_nei2[::-1]
+    path_nei1 = _oriented_path(path_nei1, nei1, node)
+    path_nei2 = _oriented_path(path_nei2, node, nei2)
 
-    new_path = path_nei1 + [node_center] + path_nei2
+    # The new path is written into a single preallocated buffer. The reversals above are views, so
+    # each pixel is copied only once
+    num_pixels1 = len(path_nei1)
+    new_path = np.empty((num_pixels1+1+len(path_nei2), len(node_center)), dtype=np.int32)
+    new_path[:num_pixels1] = path_nei1
+    new_path[num_pixels1] = node_center
+    new_path[num_pixels1+1:] = path_nei2
 
-    new_path_seg = np.array([path_nei1[-1], node_center, path_nei2[0]])
-    length_new_seg = path_length(new_path_seg, pix_size)
+    # Length of the segments path_nei1[-1] -> node center -> path_nei2[0]
+    length_new_seg = _joining_length(path_nei1[-1], node_center, path_nei2[0], pix_size)
     length_new_path = edge1_attrs['length'] + length_new_seg + edge2_attrs['length']
 
     return new_path, length_new_path
@@ -631,8 +881,9 @@ def branches_to_remove(graph, edge1, edge2, length_threshold):
     node, nei1, edge1_key = edge1
     node, nei2, edge2_key = edge2
 
+    adj = graph._adj
     branches_to_remove = []
-    if graph.degree(nei1)==1 and graph[node][nei1][edge1_key]['length']<length_threshold:
+    if _degree(adj, nei1)==1 and adj[node][nei1][edge1_key]['length']<length_threshold:
         # Identify the node with the smallest index, to ensure that edges are always represented
         # as (smallest index, largest index, key).
         if node>nei1:
@@ -640,7 +891,7 @@ def branches_to_remove(graph, edge1, edge2, length_threshold):
         else:
             n1, n2 = node, nei1
         branches_to_remove.append((n1, n2, edge1_key))
-    if graph.degree(nei2)==1 and graph[node][nei2][edge2_key]['length']<length_threshold:
+    if _degree(adj, nei2)==1 and adj[node][nei2][edge2_key]['length']<length_threshold:
         if node>nei2:
             n1, n2 = nei2, node
         else:
@@ -649,7 +900,107 @@ def branches_to_remove(graph, edge1, edge2, length_threshold):
 
     return branches_to_remove
 
-def handle_new_multiedge(graph, nei1, nei2, length_threshold, nodes_to_visit):
+def find_chain(graph, node, nei, edge_key, degrees):
+    """Auxiliary function for function `remove_degree_two_nodes`. Starting at `node`, follow the
+    edge `(node, nei, edge_key)` along a chain of degree two nodes until a node with a degree different
+    than two is found.
+
+    Parameters
+    ----------
+    graph : networkx.MultiGraph
+        The input graph.
+    node : hashable
+        A node with degree two.
+    nei : hashable
+        A neighbor of `node`.
+    edge_key : hashable
+        The key of the edge between `node` and `nei`.
+    degrees : dict
+        Cache of node degrees created in function `remove_degree_two_nodes`.
+
+    Returns
+    -------
+    chain_nodes : list of hashable
+        The nodes of the chain, starting at `node`. The last node is the end of the chain, which is
+        `node` itself if the chain loops back to it.
+    chain_keys : list of hashable
+        The keys of the edges between consecutive nodes of the chain.
+    """
+
+    adj = graph._adj
+
+    chain_nodes = [node]
+    chain_keys = [edge_key]
+    prev_node, cur_node = node, nei
+    while cur_node!=node and len(adj[cur_node])==2 and _cached_degree(adj, degrees, cur_node)==2:
+        for next_node in adj[cur_node]:
+            if next_node!=prev_node:
+                break
+        chain_nodes.append(cur_node)
+        chain_keys.append(next(iter(adj[cur_node][next_node])))
+        prev_node, cur_node = cur_node, next_node
+    chain_nodes.append(cur_node)
+
+    return chain_nodes, chain_keys
+
+def contract_chain(graph, chain_nodes, chain_keys, nodes_to_visit, degrees, pix_size):
+    """Auxiliary function for function `remove_degree_two_nodes`. Replace a chain of degree two
+    nodes found by function `find_chain` by a single edge between the first and last nodes of the
+    chain. This is the same as removing each inner node of the chain with function `make_new_path`,
+    but each pixel is copied only once instead of once for each removed node. The removed nodes are
+    also removed from `nodes_to_visit`.
+
+    Parameters
+    ----------
+    graph : networkx.MultiGraph
+        The input graph.
+    chain_nodes : list of hashable
+        The nodes of the chain.
+    chain_keys : list of hashable
+        The keys of the edges between consecutive nodes of the chain.
+    nodes_to_visit : dict
+        Stack created in function `remove_degree_two_nodes` storing nodes with degree two to be processed.
+    degrees : dict
+        Cache of node degrees created in function `remove_degree_two_nodes`.
+    pix_size : ndarray
+        The physical size of the pixels.
+    """
+
+    adj = graph._adj
+    nodes = graph._node
+
+    if chain_nodes[0]>chain_nodes[-1]:
+        # The new path must run from the node with smallest index to the node with largest index
+        chain_nodes = chain_nodes[::-1]
+        chain_keys = chain_keys[::-1]
+
+    # Paths and centers of the removed nodes are concatenated from the first to the last node
+    pieces = []
+    length = 0.
+    for idx, key in enumerate(chain_keys):
+        node1, node2 = chain_nodes[idx], chain_nodes[idx+1]
+        edge_attrs = adj[node1][node2][key]
+        path = _oriented_path(edge_attrs['path'], node1, node2)
+        if idx>0:
+            center = nodes[node1]['center']
+            length += _joining_length(pieces[-1][-1], center, path[0], pix_size)
+            pieces.append(np.array([center]))
+        pieces.append(path)
+        length += edge_attrs['length']
+
+    first_node, last_node = chain_nodes[0], chain_nodes[-1]
+    new_path = np.concatenate(pieces, dtype=np.int32)
+
+    for idx, key in enumerate(chain_keys):
+        _remove_multi_edge(adj, chain_nodes[idx], chain_nodes[idx+1], key)
+    for chain_node in chain_nodes[1:-1]:
+        nodes_to_visit.pop(chain_node, None)
+        degrees[chain_node] = 0
+    _add_multi_edge(adj, first_node, last_node, {'path':new_path, 'length':length, 'is_branch':False})
+    # The adjacency was changed directly, so the cache of the graph needs to be cleared
+    nx._clear_cache(graph)
+
+def handle_new_multiedge(graph, nei1, nei2, length_threshold, nodes_to_visit, degrees):
     """Auxiliary function for function `remove_degree_two_nodes`. This function is called when
     a node with degree two is removed from the graph but its neighbors already had a connection
     between them. In such a case, a new multiple edge is generated between the neighbors, and
@@ -671,8 +1022,12 @@ def handle_new_multiedge(graph, nei1, nei2, length_threshold, nodes_to_visit):
         Another node in the graph.
     length_threshold : float
         The threshold to decide if one of the multiple edges can be removed.
-    nodes_to_visit : list of hashable
+    nodes_to_visit : dict
         Stack created in function `remove_degree_two_nodes` storing nodes with degree two to be processed.
+        It is a dictionary with None values, used as an ordered set.
+    degrees : dict
+        Cache of node degrees created in function `remove_degree_two_nodes`. It is updated if an
+        edge is removed.
 
     Returns
     -------
@@ -683,22 +1038,27 @@ def handle_new_multiedge(graph, nei1, nei2, length_threshold, nodes_to_visit):
     was_removed = remove_small_mul(graph, nei1, nei2, 2*length_threshold)
     is_branch = False
     if was_removed:
-        nei1_degree = graph.degree(nei1)
+        adj = graph._adj
+        for nei in (nei1, nei2):
+            if nei in degrees:
+                degrees[nei] -= 1
+        nei1_degree = _cached_degree(adj, degrees, nei1)
         if nei1_degree==2:
-            nodes_to_visit.append(nei1)
+            nodes_to_visit[nei1] = None
         elif nei1_degree==1:
-            remove_if_in_list(nodes_to_visit, nei1)         # This was not in the old algorithm
+            nodes_to_visit.pop(nei1, None)         # This was not in the old algorithm
             is_branch = True
-        nei2_degree = graph.degree(nei2)
+        nei2_degree = _cached_degree(adj, degrees, nei2)
         if nei2_degree==2:
-            nodes_to_visit.append(nei2)
+            nodes_to_visit[nei2] = None
         elif nei2_degree==1:
-            remove_if_in_list(nodes_to_visit, nei2)
+            nodes_to_visit.pop(nei2, None)
             is_branch = True
 
     return is_branch
 
-def remove_degree_two_nodes(graph, length_threshold, initial_node=None, return_branch_changes=False, verbose=False):
+def remove_degree_two_nodes(graph, length_threshold, initial_node=None, return_branch_changes=False, verbose=False,
+                            pix_size=None):
     """Remove nodes having degree two from the graph, connecting its respective neighbors.
 
     A node with degree two does not have topological significance in a graph representing
@@ -747,6 +1107,8 @@ def remove_degree_two_nodes(graph, length_threshold, initial_node=None, return_b
         is used in function `remove_branches` to update a priority queue.
     verbose : bool, optional
         If True, a message indicating the start of the process is printed.
+    pix_size : ndarray, optional
+        The physical size of the pixels. If not provided, graph.graph['pix_size'] is used.
 
     Returns
     -------
@@ -758,7 +1120,8 @@ def remove_degree_two_nodes(graph, length_threshold, initial_node=None, return_b
         of the form (node1, node2, edge key). Only returned if `return_branch_changes==True`.
     """
 
-    pix_size = np.array(graph.graph['pix_size'])
+    if pix_size is None:
+        pix_size = np.array(graph.graph['pix_size'], dtype=np.float64)
 
     if verbose:
         print('\nRemoving degree two nodes...', end='')
@@ -767,35 +1130,54 @@ def remove_degree_two_nodes(graph, length_threshold, initial_node=None, return_b
         removed_branches = set()
         added_branches = set()
 
-    nodes_to_visit = []
+    # Stack of nodes to visit. A dictionary is used as an ordered set, so that nodes that no longer
+    # have degree two can be removed without searching the stack.
+    nodes_to_visit = {}
     if initial_node is None:
-        nodes_to_visit = list(degree_two_iter(graph, False, False))
+        nodes_to_visit = dict.fromkeys(degree_two_iter(graph, False, False))
     else:
         # Assumes node has degree two
         if degree_two_node_type(graph, initial_node)=='simple':
             # Node does not have self loop or multiple edges
-            nodes_to_visit = [initial_node]
+            nodes_to_visit = {initial_node:None}
 
+    # Direct access to the adjacency dictionary is much faster than the networkx views
+    adj = graph._adj
+    # Degrees of the nodes, calculated on demand and updated when edges are removed
+    degrees = {}
     while len(nodes_to_visit)>0:
 
-        node = nodes_to_visit.pop()
+        node, _ = nodes_to_visit.popitem()
 
         node_type = degree_two_node_type(graph, node)
-        node_center = graph.nodes[node]['center']
+        if node_type=='simple' and not return_branch_changes:
+            # The chains of degree two nodes on both sides of the node are contracted, so that
+            # the node is connected to the ends of the chains. Chain contraction is not used when
+            # branch changes are tracked, since it removes edges that might be in the branch queue.
+            # Chains that end at the same node form a cycle. In this case, the removal of the
+            # nodes creates multiple edges that need to be handled one node at a time.
+            nei1, nei2, edge1_key, edge2_key = two_neighbors_data(graph, node, node_type)
+            chain1 = find_chain(graph, node, nei1, edge1_key, degrees)
+            chain2 = find_chain(graph, node, nei2, edge2_key, degrees)
+            if chain1[0][-1]!=chain2[0][-1]:
+                for chain_nodes, chain_keys in (chain1, chain2):
+                    if len(chain_keys)>1:
+                        contract_chain(graph, chain_nodes, chain_keys, nodes_to_visit, degrees, pix_size)
+
         nei1, nei2, edge1_key, edge2_key = two_neighbors_data(graph, node, node_type)
-        new_path, length_new_path = make_new_path(graph, (node, nei1, edge1_key), (node, nei2, edge2_key))
+        new_path, length_new_path = make_new_path(graph, (node, nei1, edge1_key), (node, nei2, edge2_key), pix_size)
 
         has_nei_edge = False
         is_branch = False
         if node_type=='multiple':
-            if graph.degree(nei1)==2:
+            if _cached_degree(adj, degrees, nei1)==2:
                 # After the removal of the edge, nei1 will not have degree 2
-                nodes_to_visit.remove(nei1)
+                nodes_to_visit.pop(nei1, None)
         else:
-            if graph.has_edge(nei1, nei2):
+            if nei2 in adj[nei1]:
                 has_nei_edge = True
             else:
-                if graph.degree(nei1)==1 or graph.degree(nei2)==1:
+                if _cached_degree(adj, degrees, nei1)==1 or _cached_degree(adj, degrees, nei2)==1:
                     is_branch = True
 
         if is_branch and return_branch_changes:
@@ -808,16 +1190,21 @@ def remove_degree_two_nodes(graph, length_threshold, initial_node=None, return_b
                 else:
                     removed_branches.add(branch)
 
-        graph.remove_edges_from([(node, nei1, edge1_key), (node, nei2, edge2_key)])
-        graph.add_edge(nei1, nei2, **{'path':new_path, 'length':length_new_path, 'is_branch':is_branch})
+        _remove_multi_edge(adj, node, nei1, edge1_key)
+        _remove_multi_edge(adj, node, nei2, edge2_key)
+        _add_multi_edge(adj, nei1, nei2, {'path':new_path, 'length':length_new_path, 'is_branch':is_branch})
+        nx._clear_cache(graph)     # The adjacency was changed directly
+        # The neighbors lost one edge each and gained the new edge, so only the degree of the
+        # removed node changed
+        degrees[node] = 0
 
         if has_nei_edge:
             # A new multiple edge was created
-            is_branch = handle_new_multiedge(graph, nei1, nei2, length_threshold, nodes_to_visit)
+            is_branch = handle_new_multiedge(graph, nei1, nei2, length_threshold, nodes_to_visit, degrees)
 
         if is_branch:
-            nei_edge_key = get_single_edge_key(graph, nei1, nei2)
-            graph[nei1][nei2][nei_edge_key]['is_branch'] = True
+            nei_edge_key = next(iter(adj[nei1][nei2]))
+            adj[nei1][nei2][nei_edge_key]['is_branch'] = True
             if return_branch_changes:
                 if length_new_path<length_threshold:
                     added_branches.add((nei1, nei2, nei_edge_key))
@@ -825,94 +1212,7 @@ def remove_degree_two_nodes(graph, length_threshold, initial_node=None, return_b
     if return_branch_changes:
         return added_branches, removed_branches
 
-def _remove_degree_two_nodes_old(graph, length_threshold, initial_node=None, verbose=False):
-    """Remove nodes having degree two from the graph, connecting its respective neighbors.
-    Old implementation, please use function `remove_degree_two_nodes_old` instead."""
-
-    pix_size = np.array(graph.graph['pix_size'])
-
-    if verbose:
-        print('\nRemoving degree two nodes...', end='')
-
-    nodes_to_visit = []
-    if initial_node is None:
-        nodes_to_visit = list(degree_two_iter(graph, False, False))
-    else:
-        # Assumes node has degree two
-        if degree_two_node_type(graph, initial_node)=='simple':
-            # Node does not have self loop or multiple edges
-            nodes_to_visit = [initial_node]
-
-    while len(nodes_to_visit)>0:
-
-        node = nodes_to_visit.pop()
-
-        node_type = degree_two_node_type(graph, node)
-        node_center = graph.nodes[node]['center']
-        neighbors = list(graph.neighbors(node))
-        if node_type=='simple':
-            nei1, nei2 = neighbors
-            edge1_key = get_single_edge_key(graph, node, nei1)   # Cannot assume key is 0
-            edge2_key = get_single_edge_key(graph, node, nei2)
-        elif node_type=='multiple':
-            nei1 = nei2 = neighbors[0]
-            edge1_key, edge2_key = list(graph[node][nei1].keys())
-        elif node_type=='loop':
-            raise ValueError('Cannot process self-loop.')
-
-        edge1_attrs = graph[node][nei1][edge1_key]
-        edge2_attrs = graph[node][nei2][edge2_key]
-        path_nei1 = edge1_attrs['path']
-        path_nei2 = edge2_attrs['path']
-
-        if node<nei1:
-            # If node<nei1, path runs from node to nei1, we need to reverse that
-            path_nei1 = path_nei1[::-1]
-        if node>nei2:
-            path_nei2 = path_nei2[::-1]
-
-        new_path = path_nei1 + [node_center] + path_nei2
-        if nei1>nei2:
-            new_path = new_path[::-1]
-
-        new_path_seg = np.array([path_nei1[-1], node_center, path_nei2[0]])
-        length_new_seg = path_length(new_path_seg, pix_size)
-        length_new_path = edge1_attrs['length'] + length_new_seg + edge2_attrs['length']
-
-        has_nei_edge = False
-        is_branch = False
-        if node_type=='multiple':
-            if graph.degree(nei1)==2:
-                nodes_to_visit.remove(nei1)
-        else:
-            if graph.has_edge(nei1, nei2):
-                has_nei_edge = True
-            else:
-                if graph.degree(nei1)==1 or graph.degree(nei2)==1:
-                    is_branch = True
-
-        graph.remove_edges_from([(node, nei1, edge1_key), (node, nei2, edge2_key)])
-        graph.add_edge(nei1, nei2, **{'path':new_path, 'length':length_new_path, 'is_branch':is_branch})
-
-        if has_nei_edge:
-            was_removed = remove_small_mul(graph, nei1, nei2, 2*length_threshold)
-            if was_removed:
-                nei1_degree = graph.degree(nei1)
-                if nei1_degree==2:
-                    nodes_to_visit.append(nei1)
-                elif nei1_degree==1:
-                    remove_if_in_list(nodes_to_visit, nei1)         # This was not in the old algorithm
-                    nei_edge_key = get_single_edge_key(graph, nei1, nei2)
-                    graph[nei1][nei2][nei_edge_key]['is_branch'] = True
-                nei2_degree = graph.degree(nei2)
-                if nei2_degree==2:
-                    nodes_to_visit.append(nei2)
-                elif nei2_degree==1:
-                    remove_if_in_list(nodes_to_visit, nei2)
-                    nei_edge_key = get_single_edge_key(graph, nei1, nei2)
-                    graph[nei1][nei2][nei_edge_key]['is_branch'] = True
-
-def remove_branches(graph, length_threshold, verbose=False):
+def remove_branches(graph, length_threshold, verbose=False, pix_size=None):
     """Remove graph edges associated with small branches. A branch edge is defined as an
     edge incident on at least one node with degree one (i.e., a termination).
 
@@ -934,101 +1234,124 @@ def remove_branches(graph, length_threshold, verbose=False):
         Branches with size smaller than `length_threshold` are removed.
     verbose : bool, optional
         If True, the progress of the removal is printed.
+    pix_size : ndarray, optional
+        The physical size of the pixels. If not provided, graph.graph['pix_size'] is used.
     """
 
-    pix_size = np.array(graph.graph['pix_size'])
+    if pix_size is None:
+        pix_size = np.array(graph.graph['pix_size'], dtype=np.float64)
     if verbose:
         print('\nRemoving branches...')
         num_branches_removed = 0
 
-    # Create priority queue for all branches smaller than `length_threshold`
-    branch_small_edges = list(filter(lambda edge: edge[3]['is_branch'] and edge[3]['length']<length_threshold,
-                                     graph.edges(data=True, keys=True)))
-    if len(branch_small_edges)==0:
+    # Create priority queue for all branches smaller than `length_threshold`. The queue is a heap
+    # with entries (length, count, edge). Entries are never removed from the heap when a branch
+    # changes. Instead, the count of the valid entry of each edge is stored in `entry_counts` and
+    # entries with a different count are ignored when popped.
+    branch_queue = [(edge_attrs['length'], count, (node1, node2, key)) for count, (node1, node2, key, edge_attrs)
+                    in enumerate(graph.edges(keys=True, data=True))
+                    if edge_attrs['is_branch'] and edge_attrs['length']<length_threshold]
+    if len(branch_queue)==0:
         return
 
-    branch_small_edges = map(lambda edge: (edge[3]['length'], (edge[0], edge[1], edge[2])), branch_small_edges)
-    lengths, edges = zip(*branch_small_edges)
-    branch_queue = util.PriorityQueue(lengths, edges)
+    counter = itertools.count(branch_queue[-1][1]+1)
+    entry_counts = {edge:count for _, count, edge in branch_queue}
+    heapq.heapify(branch_queue)
+
+    # Invariant: the edges of the graph are scanned only once, above. After that, an edge only
+    # enters the queue when it becomes a branch, either during the removal of a degree two node
+    # or after the removal of a branch. Please do not add rescans of the graph inside the loop.
 
-    while branch_queue:
+    # Direct access to the adjacency dictionary is much faster than the networkx views
+    adj = graph._adj
+    heappush, heappop = heapq.heappush, heapq.heappop
+    while entry_counts:
+
+        length_smal_edge, count, branch = heappop(branch_queue)
+        if entry_counts.get(branch)!=count:
+            # Stale entry
+            continue
+        del entry_counts[branch]
 
         if verbose:
             if num_branches_removed%10==0:
                 print(f'\r{num_branches_removed} branches removed', end='')
             num_branches_removed += 1
 
-        length_smal_edge, (node1, node2, key), _ = branch_queue.pop_task()
+        node1, node2, key = branch
         graph.remove_edge(node1, node2, key)
 
         # Since an edge was removed, we need to check if an incident node now has degree 1 or 2
-        if graph.degree(node1)==0:
+        if len(adj[node1])==0:
             target_node = node2
         else:
             target_node = node1
 
-        target_node_degree = graph.degree(target_node)
+        target_node_degree = _degree(adj, target_node)
         if target_node_degree==2:
-            added_branches, removed_branches = remove_degree_two_nodes(graph, length_threshold,
-                                                                       target_node, return_branch_changes=True)
+            added_branches, removed_branches = remove_degree_two_nodes(graph, length_threshold, target_node,
+                                                                       return_branch_changes=True, pix_size=pix_size)
             for branch in added_branches:
                 node1, node2, key = branch
-                branch_queue.add_task(graph[node1][node2][key]['length'], branch)
+                count = next(counter)
+                heappush(branch_queue, (adj[node1][node2][key]['length'], count, branch))
+                entry_counts[branch] = count
             for branch in removed_branches:
-                branch_queue.remove_task(branch)
+                del entry_counts[branch]
         elif target_node_degree==1:
-            target_neighbor = get_single_neighbor(graph, target_node)
-            target_edge_key = get_single_edge_key(graph, target_node, target_neighbor)
-            target_edge = graph[target_node][target_neighbor][target_edge_key]
+            target_neighbor = next(iter(adj[target_node]))
+            target_edge_key = next(iter(adj[target_node][target_neighbor]))
+            target_edge = adj[target_node][target_neighbor][target_edge_key]
             target_edge['is_branch'] = True
-            branch_queue.add_task(target_edge['length'], (target_node, target_neighbor, target_edge_key))
-
-def _remove_branches_old(graph, length_threshold, verbose=False):
-    """Remove graph edges associated with small branches. A branch edge is defined as an
-    edge incident on at least one node with degree one (i.e., a termination).
-    Old implementation, please use function `remove_branches` instead.
-    """
-
-    pix_size = np.array(graph.graph['pix_size'])
-    if verbose:
-        print('\nRemoving branches...')
-        num_branches_removed = 0
+            branch = (target_node, target_neighbor, target_edge_key)
+            count = next(counter)
+            heappush(branch_queue, (target_edge['length'], count, branch))
+            entry_counts[branch] = count
 
-    branch_removed = True
-    while branch_removed:
+def _relabel_to_integers(graph, label_attribute='old_id'):
+    """Relabel the nodes of a graph with consecutive integers, following the order of the nodes. The
+    graph is modified in-place and the original label of each node is stored in the node attribute
+    `label_attribute`. The result is the same as the one returned by nx.convert_node_labels_to_integers,
+    but the node and edge attributes are reused instead of copied to a new graph.
 
-        if verbose:
-            if num_branches_removed%10==0:
-                print(f'\r{num_branches_removed} branches removed', end='')
-            num_branches_removed += 1
+    Parameters
+    ----------
+    graph : networkx.MultiGraph
+        The input graph.
+    label_attribute : str, optional
+        Name of the node attribute that stores the original labels.
+    """
 
-        branch_edges = list(filter(lambda edge: edge[3], graph.edges(data='is_branch', keys=True)))
-        if len(branch_edges)>0:
-            lengths = [graph[edge[0]][edge[1]][edge[2]]['length'] for edge in branch_edges]
-            ind_smal_edge = argmin(lengths)
-            length_smal_edge = lengths[ind_smal_edge]
-            if length_smal_edge<length_threshold:
-                smallest_edge = branch_edges[ind_smal_edge]
-                node1, node2, key, _ = smallest_edge
-                graph.remove_edge(node1, node2, key)
-
-                # Since an edge was removed, we need to check if a node now has degree 1 or 2
-                if graph.degree(node1)==0:
-                    target_node = node2
-                else:
-                    target_node = node1
-
-                target_node_degree = graph.degree(target_node)
-                if target_node_degree==2:
-                    remove_degree_two_nodes(graph, length_threshold, target_node)
-                elif target_node_degree==1:
-                    target_neighbor = get_single_neighbor(graph, target_node)
-                    target_edge_key = get_single_edge_key(graph, target_node, target_neighbor)
-                    graph[target_node][target_neighbor][target_edge_key]['is_branch'] = True
-            else:
-                branch_removed = False
-        else:
-            branch_removed = False
+    nodes = graph._node
+    adj = graph._adj
+    mapping = {node:idx for idx, node in enumerate(nodes)}
+
+    new_nodes = {}
+    for node, node_attrs in nodes.items():
+        node_attrs[label_attribute] = node
+        new_nodes[mapping[node]] = node_attrs
+
+    # Edges are inserted in the order given by graph.edges, as done by networkx when creating a
+    # relabeled copy of the graph. The key dictionary of an edge is shared by both directions.
+    new_adj = {idx:{} for idx in range(len(mapping))}
+    for node1, node2, key, edge_attrs in graph.edges(keys=True, data=True):
+        new_node1, new_node2 = mapping[node1], mapping[node2]
+        neighbors = new_adj[new_node1]
+        if new_node2 not in neighbors:
+            edges = {}
+            neighbors[new_node2] = edges
+            new_adj[new_node2][new_node1] = edges
+        neighbors[new_node2][key] = edge_attrs
+
+    # The dictionaries are updated instead of replaced, since networkx views keep references to them.
+    # The input graph is consumed: the attribute dictionaries of its nodes and edges are moved to the
+    # relabeled graph without being copied, so callers that need the original graph must pass a copy,
+    # as done by adjust_graph
+    nodes.clear()
+    nodes.update(new_nodes)
+    adj.clear()
+    adj.update(new_adj)
+    nx._clear_cache(graph)
 
 def adjust_graph(graph, length_threshold, keep_nodes=False, collapse_indices=True, verbose=False):
     """Adjust the nodes and edges of a graph, using some heuristics to simplify its topology.
@@ -1066,23 +1389,23 @@ def adjust_graph(graph, length_threshold, keep_nodes=False, collapse_indices=Tru
     """
 
     new_graph = graph.copy()
+    # The pixel size array is created once and shared by all steps
+    pix_size = np.array(new_graph.graph['pix_size'], dtype=np.float64)
 
-    add_length(new_graph)
+    add_length(new_graph, pix_size)
     add_branch_info(new_graph)
 
     remove_small_mul_all(new_graph, 2*length_threshold)
-    remove_degree_two_nodes(new_graph, length_threshold, verbose=verbose)
-    remove_branches(new_graph, length_threshold, verbose)
+    remove_degree_two_nodes(new_graph, length_threshold, verbose=verbose, pix_size=pix_size)
+    remove_branches(new_graph, length_threshold, verbose, pix_size)
     remove_small_graph_components(new_graph, 2*length_threshold)
 
     if not keep_nodes:
-        zero_degree_nodes = list(filter(lambda x: x[1]==0, dict(new_graph.degree()).items()))
-        if len(zero_degree_nodes)>0:
-            zero_degree_nodes = list(zip(*zero_degree_nodes))[0]
-            new_graph.remove_nodes_from(zero_degree_nodes)
+        zero_degree_nodes = [node for node, degree in new_graph.degree() if degree==0]
+        new_graph.remove_nodes_from(zero_degree_nodes)
 
         if collapse_indices:
-            new_graph = nx.convert_node_labels_to_integers(new_graph, ordering='default', label_attribute='old_id')
+            _relabel_to_integers(new_graph, label_attribute='old_id')
 
     return new_graph
 
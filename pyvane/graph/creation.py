@@ -4,6 +4,13 @@ import numpy as np
 from scipy import ndimage as ndi
 import networkx as nx
 import pyvane.util as util
+from pyvane.graph import _kernels
+
+# Offsets of the neighbors of a pixel, in lexicographic order
+_NEI_2D = np.array([(d0, d1) for d0 in (-1, 0, 1) for d1 in (-1, 0, 1) if (d0, d1)!=(0, 0)],
+                   dtype=np.int32)
+_NEI_3D = np.array([(d0, d1, d2) for d0 in (-1, 0, 1) for d1 in (-1, 0, 1) for d2 in (-1, 0, 1)
+                    if (d0, d1, d2)!=(0, 0, 0)], dtype=np.int32)
 
 class InterestPoint:
     """Class representing a termination or bifurcation point.
@@ -13,25 +20,31 @@ class InterestPoint:
 
     Parameters
     ----------
-    pixels_coords : list of tuple
-        Coordinates of the pixels associated to the interest point.
+    pixels_coords : list of tuple or ndarray
+        Coordinates of the pixels associated to the interest point. Can also be an array of shape
+        (num_pixels, ndim).
     point_type : {'bifurcation', 'termination'}
         Type of the point.
 
     Attributes
     ----------
+    pixels_arr : ndarray
+        Array of shape (num_pixels, ndim) and type int32 containing the coordinates of the pixels
+        associated to the interest point.
     pixels : list of tuple
-        Coordinates of the pixels associated to the interest point.
+        Coordinates of the pixels associated to the interest point. Generated from `pixels_arr`.
     center : tuple
         Center point of the interest point.
     type : str
         Type of the interest point.
     ndim : int
         Number of coordinates of the point.
+    branches_arr : ndarray
+        Array of shape (num_branches, ndim) and type int32 containing the branches associated to the
+        point. A branch is a pixel having two neighbors, one of which is the interest point. The array is
+        initially empty. Method self.add_branches needs to be called for populating the variable.
     branches : list of tuple
-        Branches associated to the point. A branch is a pixel having two neighbors, one of which is the
-        interest point. The list is initially empty. Method self.add_branches needs to be called for
-        populating the variable.
+        Branches associated to the point. Generated from `branches_arr`.
     """
 
     point_code_to_name = {0:'bifurcation', 1:'termination'}
@@ -39,14 +52,30 @@ class InterestPoint:
 
     def __init__(self, pixels_coords, point_type):
 
-        center = np.mean(pixels_coords, axis=0)             # Calculate center
+        self.pixels_arr = np.array(pixels_coords, dtype=np.int32, ndmin=2)
+        center = self.pixels_arr.mean(axis=0)              # Calculate center
         center_int = tuple(np.round(center).astype(int))
 
-        self.pixels = list(map(tuple, pixels_coords))       # Store as list of tuples
         self.center = center_int
         self.type = point_type
-        self.ndim = len(center)
-        self.branches = []
+        self.ndim = self.pixels_arr.shape[1]
+        self.branches_arr = np.empty((0, self.ndim), dtype=np.int32)
+
+    @property
+    def pixels(self):
+        return list(map(tuple, self.pixels_arr.tolist()))
+
+    @pixels.setter
+    def pixels(self, pixels_coords):
+        self.pixels_arr = np.array(pixels_coords, dtype=np.int32).reshape(-1, self.ndim)
+
+    @property
+    def branches(self):
+        return list(map(tuple, self.branches_arr.tolist()))
+
+    @branches.setter
+    def branches(self, branches):
+        self.branches_arr = np.array(branches, dtype=np.int32).reshape(-1, self.ndim)
 
     def add_branches(self, img_num_neighbors):
         """Obtain branches (pixels with two neighbors) connected to an interest point.
@@ -55,29 +84,27 @@ class InterestPoint:
         ----------
         img_num_neighbors : ndarray
             Each element of the array contain the number of neighbors of a pixel in some binary image.
-            For instance, the center point of a cross has 4 neighbors.
+            For instance, the center point of a cross has 4 neighbors. The image must be padded with
+            a border of background pixels, since no bounds check is done for the neighbors.
 
         Returns
         -------
         branches : list of tuple
-            The identified branches. The branches will also be added to self.branches.
+            The identified branches. The branches will also be added to self.branches_arr.
         """
 
         if self.ndim != img_num_neighbors.ndim:
             raise ValueError(f'Dimension mismatch between interest point ({self.ndim}) and neighborhood image ({img_num_neighbors.ndim})')
 
-        if len(self.branches)>0:
+        if len(self.branches_arr)>0:
             return self.branches
 
-        branches = set()
-        for pixel in self.pixels:
-            for neighbor in iterate_neighbors(pixel):
-                if is_inside(neighbor, img_num_neighbors.shape):
-                    if img_num_neighbors[neighbor]==2:
-                        branches.add(neighbor)
+        neighbors = self.pixels_arr[:, None] + _neighbor_deltas(self.ndim)
+        neighbors = neighbors.reshape(-1, self.ndim)
+        is_branch = img_num_neighbors[tuple(neighbors.T)]==2
 
-        self.branches = list(map(tuple, branches))
-        return branches
+        self.branches_arr = np.unique(neighbors[is_branch], axis=0)
+        return self.branches
 
     @classmethod
     def map_point_type(cls, point_type, code_to_name=True):
@@ -106,109 +133,45 @@ class InterestPoint:
             return cls.point_name_to_code(point_type)
 
 class BranchMap:
-    """Auxiliary map for keeping track of interest points associated to each branch pixel.
+    """Auxiliary map for keeping track of interest points associated to each branch pixel. Branches
+    are identified by their linear index on an array with shape `shape`.
 
     Parameters
     ----------
     ips : list of InterestPoint
         Interest points whose branches will be mapped.
-    """
-
-    def __init__(self, ips):
-
-        branch_map = {}
-        for ip_idx, ip in enumerate(ips):
-            for branch in ip.branches:
-                if branch in branch_map:
-                    branch_map[branch].add(ip_idx)
-                else:
-                    branch_map[branch] = set([ip_idx])
-
-        self.branch_map = branch_map
-
-    def get_ip_ids(self, branch):
-        """Given a branch pixel, returns the indices of the interest points associated to the branch.
-        Usually, a list containing a single index is returned, but on some corner cases two values
-        may be returned.
-
-        Parameters
-        ----------
-        branch : tuple of int
-            The coordinates of the branch.
-
-        Returns
-        -------
-        list of int
-            The indices of the interest points associated to the branch.
-        """
+    shape : tuple of int
+        Shape of the image containing the interest points.
 
-        return list(self.branch_map[branch])
-
-
-def is_inside(pixel_coord, img_shape):
-    """Check if pixel is inside image.
-
-    Parameters
+    Attributes
     ----------
-    pixel_coord : tuple of int
-        Pixel to check.
-    img_shape : tuple of int
-        Size of the image.
-
-    Returns
-    -------
-    is_inside : bool
-        True if pixel is inside the image or False otherwise.
+    branches_lin : ndarray
+        Linear indices of the branches of all points. The branches of point i are given by
+        branches_lin[branch_bounds[i]:branch_bounds[i+1]].
+    branch_bounds : ndarray
+        Bounds of the branches of each point in `branches_lin`.
+    branch_keys : ndarray
+        Sorted linear indices of the branches.
+    ip_ids : ndarray
+        Index of the interest point associated to each element of `branch_keys`.
     """
 
-    is_inside = (pixel_coord[0]>=0) and (pixel_coord[1]>=0) and (pixel_coord[0]<img_shape[0]) and (pixel_coord[1]<img_shape[1])
-    if len(img_shape)==3:
-        is_inside = is_inside and (pixel_coord[2]>=0) and (pixel_coord[2]<img_shape[2])
+    def __init__(self, ips, shape):
 
-    return is_inside
+        ndim = len(shape)
+        num_branches = [len(ip.branches_arr) for ip in ips]
+        branches = np.concatenate([np.empty((0, ndim), dtype=np.int32)]+[ip.branches_arr for ip in ips])
+        self.branches_lin = np.ravel_multi_index(tuple(branches.T), shape).astype(np.int64)
+        self.branch_bounds = np.zeros(len(ips)+1, dtype=np.int64)
+        np.cumsum(num_branches, out=self.branch_bounds[1:])
 
-def iterate_neighbors(pixel_coords):
-    """Iterate over neighbors of a given pixel. Works for 2D and 3D images.
+        # Sorted table of branch linear indices and the respective interest points
+        ip_ids = np.repeat(np.arange(len(ips)), num_branches)
+        order = np.argsort(self.branches_lin, kind='stable')
+        self.branch_keys = self.branches_lin[order]
+        self.ip_ids = ip_ids[order]
+        self.shape = shape
 
-    Parameters
-    ----------
-    pixel_coord : tuple of int
-        Reference pixel.
-
-    Yields
-    -------
-    tuple of int
-        The neighbors of the pixel.
-    """
-
-    if len(pixel_coords)==2:
-
-        neis = [(pixel_coords[0]-1, pixel_coords[1]-1), (pixel_coords[0]-1, pixel_coords[1]),
-                (pixel_coords[0]-1, pixel_coords[1]+1), (pixel_coords[0], pixel_coords[1]-1),
-                (pixel_coords[0], pixel_coords[1]+1), (pixel_coords[0]+1, pixel_coords[1]-1),
-                (pixel_coords[0]+1, pixel_coords[1]), (pixel_coords[0]+1, pixel_coords[1]+1)]
-
-    elif len(pixel_coords)==3:
-
-        neis = [(pixel_coords[0]-1, pixel_coords[1]-1, pixel_coords[2]-1), (pixel_coords[0]-1, pixel_coords[1]-1, pixel_coords[2]  ),
-                (pixel_coords[0]-1, pixel_coords[1]-1, pixel_coords[2]+1), (pixel_coords[0]-1, pixel_coords[1]  , pixel_coords[2]-1),
-                (pixel_coords[0]-1, pixel_coords[1]  , pixel_coords[2]  ), (pixel_coords[0]-1, pixel_coords[1]  , pixel_coords[2]+1),
-                (pixel_coords[0]-1, pixel_coords[1]+1, pixel_coords[2]-1), (pixel_coords[0]-1, pixel_coords[1]+1, pixel_coords[2]  ),
-                (pixel_coords[0]-1, pixel_coords[1]+1, pixel_coords[2]+1),
-                (pixel_coords[0]  , pixel_coords[1]-1, pixel_coords[2]-1), (pixel_coords[0]  , pixel_coords[1]-1, pixel_coords[2]  ),
-                (pixel_coords[0]  , pixel_coords[1]-1, pixel_coords[2]+1), (pixel_coords[0]  , pixel_coords[1]  , pixel_coords[2]-1),
-                                                                           (pixel_coords[0]  , pixel_coords[1]  , pixel_coords[2]+1),
-                (pixel_coords[0]  , pixel_coords[1]+1, pixel_coords[2]-1), (pixel_coords[0]  , pixel_coords[1]+1, pixel_coords[2]  ),
-                (pixel_coords[0]  , pixel_coords[1]+1, pixel_coords[2]+1),
-                (pixel_coords[0]+1, pixel_coords[1]-1, pixel_coords[2]-1), (pixel_coords[0]+1, pixel_coords[1]-1, pixel_coords[2]  ),
-                (pixel_coords[0]+1, pixel_coords[1]-1, pixel_coords[2]+1), (pixel_coords[0]+1, pixel_coords[1]  , pixel_coords[2]-1),
-                (pixel_coords[0]+1, pixel_coords[1]  , pixel_coords[2]  ), (pixel_coords[0]+1, pixel_coords[1]  , pixel_coords[2]+1),
-                (pixel_coords[0]+1, pixel_coords[1]+1, pixel_coords[2]-1), (pixel_coords[0]+1, pixel_coords[1]+1, pixel_coords[2]  ),
-                (pixel_coords[0]+1, pixel_coords[1]+1, pixel_coords[2]+1)
-               ]
-
-    for n in neis:
-        yield n
 
 def find_interest_points_type(img_comps, point_type_name, structure, verbose=False):
     """Identifies interest points (terminations or bifurcations) on a binary image. See function
@@ -232,23 +195,25 @@ def find_interest_points_type(img_comps, point_type_name, structure, verbose=Fal
     """
 
     img_label, num_comps = ndi.label(img_comps, structure)   # Connected components
-    components = ndi.find_objects(img_label)
+
+    # Coordinates of all labeled pixels, grouped by component. The stable sort keeps the pixels
+    # of each component in raster order
+    coords = np.argwhere(img_label>0)
+    labels = img_label[tuple(coords.T)]
+    order = np.argsort(labels, kind='stable')
+    coords = coords[order]
+    comp_bounds = np.searchsorted(labels[order], np.arange(1, num_comps+2))
+
     if verbose:
-        num_components = len(components)
-        print_interv = util.get_print_interval(num_components)
+        print_interv = util.get_print_interval(num_comps)
+    point_type = InterestPoint.point_name_to_code[point_type_name]
     interest_points = []
-    for idx, component in enumerate(components):
+    for idx in range(num_comps):
         if verbose:
-            if idx%print_interv==0 or idx==num_components-1:
-                print(f'\rProcessing point {idx+1} of {num_components}...', end='')
-
-        # Get coordinate of pixels inside region and transform to image (global) coordinates
-        coords = np.nonzero(img_label[component]==idx+1)
-        global_coords = []
-        for idx, coord_axis in enumerate(coords):
-            global_coords.append(coord_axis + component[idx].start)
-        global_coords = list(zip(*global_coords))
-        ip = InterestPoint(global_coords, InterestPoint.point_name_to_code[point_type_name])
+            if idx%print_interv==0 or idx==num_comps-1:
+                print(f'\rProcessing point {idx+1} of {num_comps}...', end='')
+
+        ip = InterestPoint(coords[comp_bounds[idx]:comp_bounds[idx+1]], point_type)
         interest_points.append(ip)
 
     return interest_points
@@ -276,13 +241,13 @@ def find_interest_points(img_num_neighbors, verbose=False):
     # Bifurcations
     if verbose:
         print('Detecting bifurcations...')
-    img_comps = img_num_neighbors >= 3
+    img_comps = np.greater_equal(img_num_neighbors, 3)
     ip_bif = find_interest_points_type(img_comps, 'bifurcation', structure, verbose)
 
-    # Terminations
+    # Terminations. The mask of bifurcations is not needed anymore, so its memory is reused
     if verbose:
         print('\nDetecting terminations...')
-    img_comps = img_num_neighbors == 1
+    np.equal(img_num_neighbors, 1, out=img_comps)
     ip_term = find_interest_points_type(img_comps, 'termination', structure, verbose)
 
     interest_points = ip_bif + ip_term
@@ -298,93 +263,56 @@ def add_branches_to_ips(ips, img_num_neighbors, verbose=False):
         Interest points.
     img_num_neighbors : ndarray
         Each element of the array contains the number of neighbors of a pixel in some binary image.
-        For instance, the center point of a cross has 4 neighbors.
+        For instance, the center point of a cross has 4 neighbors. The image must be padded with
+        a border of background pixels, since no bounds check is done for the neighbors.
     verbose : bool
         If True, the progress is printed.
     """
 
     if verbose:
         print('\nAdding branches...')
-    if verbose:
-        num_points = len(ips)
-        print_interv = util.get_print_interval(num_points)
-    for idx, ip in enumerate(ips):
-        if verbose:
-            if idx%print_interv==0 or idx==num_points-1:
-                print(f'\rProcessing point {idx+1} of {num_points}...', end='')
-        ip.add_branches(img_num_neighbors)
 
-def track_branch(interest_point, branch_index, img_num_neighbors):
-    '''Track a given branch starting at a bifurcation or termination, stopping when finding
-    another termination or bifurcation.  `branch_index` sets the branch to track (0, 1, 2, etc).
-    `img_num_neighbors` contains the number of neighbors for each pixel.
+    shape = img_num_neighbors.shape
+    ndim = len(shape)
+    for ip in ips:
+        if ip.ndim != ndim:
+            raise ValueError(f'Dimension mismatch between interest point ({ip.ndim}) and neighborhood image ({ndim})')
 
-    Parameters
-    ----------
-    interest_point : InterestPoint
-        Starting point of the tracking process.
-    branch_index : int
-        Index of the branch to track.
-    img_num_neighbors : ndarray
-        Each element of the array contains the number of neighbors of a pixel in some binary image.
-        For instance, the center point of a cross has 4 neighbors.
+    # Neighbors of all pixels of all points, together with the index of the respective point
+    deltas = _neighbor_deltas(ndim)
+    pixels = np.concatenate([np.empty((0, ndim), dtype=np.int32)]+[ip.pixels_arr for ip in ips])
+    ip_ids = np.repeat(np.arange(len(ips)), [len(ip.pixels_arr) for ip in ips])
+    neighbors = (pixels[:, None] + deltas).reshape(-1, ndim)
+    ip_ids = np.repeat(ip_ids, len(deltas))
 
-    Returns
-    -------
-    path : list of tuple
-        Pixels between two interest points. All pixels in `path` have two neighbors. The first pixel
-        is a branch of `interest_point` and the last pixel is a branch of some other interest point.
-    '''
+    is_branch = img_num_neighbors[tuple(neighbors.T)]==2
+    branches_lin = np.ravel_multi_index(tuple(neighbors[is_branch].T), shape)
 
-    if len(interest_point.branches)<=branch_index:
-        print('Warning! There is no branch with the given index')
-        return []
-
-    first_point = interest_point.branches[branch_index]
-    second_point = None
-    for neighbor in iterate_neighbors(first_point):
-        if img_num_neighbors[neighbor]==2:
-            second_point = neighbor
-
-    path = [first_point]
-    if second_point is not None:     # If None, path has only one point
-        path.append(second_point)
-        prev_point = first_point
-        curr_point = second_point
-        found_neighbor = True
-        while found_neighbor:        # While there is a neighbor with value 2 in img_num_neighbors
-            found_neighbor = False
-            for neighbor in iterate_neighbors(curr_point):
-                if (img_num_neighbors[neighbor]==2) and (neighbor!=prev_point):
-                    # If neighbor is found, add to path and update current and previous points
-                    path.append(neighbor)
-                    prev_point = curr_point
-                    curr_point = neighbor
-                    found_neighbor = True
-                    break
-
-    return path
-
-def find_path_ip(path, ips):
-    '''For a given path, find the interest point that is a neighbor of the last point in the path.
+    # Unique (point, branch) pairs, sorted by point and then by branch
+    keys = np.unique(ip_ids[is_branch]*img_num_neighbors.size + branches_lin)
+    ip_ids, branches_lin = np.divmod(keys, img_num_neighbors.size)
+    branches = np.stack(np.unravel_index(branches_lin, shape), axis=1).astype(np.int32)
 
-    Parameters
-    ----------
-    path : list of tuple
-        Pixels returned by function `track_branch`.
-    ips : list of InterestPoint
-        Interest points to search.
+    ip_bounds = np.searchsorted(ip_ids, np.arange(len(ips)+1))
+    for idx, ip in enumerate(ips):
+        ip.branches_arr = branches[ip_bounds[idx]:ip_bounds[idx+1]]
 
-    Returns
-    -------
-    idx : int
-        Index of the interest point sought.
-    '''
+def _neighbor_deltas(ndim):
+    """Coordinate offsets of the neighbors of a pixel, given by `_NEI_2D` or `_NEI_3D`. The offsets
+    are in lexicographic order, from (-1, -1) to (1, 1) in 2D."""
 
-    last_path_point = path[-1]
-    for idx, ip in enumerate(ips):
-        if last_path_point in ip.branches:
-            return idx
+    if ndim==2:
+        return _NEI_2D
+    elif ndim==3:
+        return _NEI_3D
+
+def _make_neighbor_offsets(shape):
+    """Linear index offsets of the neighbors of a pixel in a C-contiguous array with the given shape.
+    The offsets follow the order of the rows of `_NEI_2D` or `_NEI_3D`."""
+
+    strides = np.cumprod((shape[1:]+(1,))[::-1])[::-1]
+
+    return _neighbor_deltas(len(shape)) @ strides
 
 def track_branches(ips, img_num_neighbors, verbose=False):
     '''Track branches of interest points in `ips`. For a given branch of an interest point, the tracking starts
@@ -405,39 +333,23 @@ def track_branches(ips, img_num_neighbors, verbose=False):
     -------
     edges : list of tuple
         Paths tracked. Each element of the list is a tuple of the form (ip1_idx, ip2_idx, path), where ip1_idx
-        and ip2_idx are the indices of the interest points and path a list of pixels between the two points.
+        and ip2_idx are the indices of the interest points and path an int32 array of shape (num_pixels, ndim)
+        containing the pixels between the two points.
     '''
 
     if verbose:
         print('\nTracking branches...')
 
-    branch_map = BranchMap(ips)
-    if verbose:
-        num_points = len(ips)
-        print_interv = util.get_print_interval(num_points)
-    visited_branches = set()
+    shape = img_num_neighbors.shape
+    branch_map = BranchMap(ips, shape)
+    ip_ids, path_bounds, paths_lin = _kernels.track_branches_nb(img_num_neighbors.ravel(), _make_neighbor_offsets(shape),
+                                                                branch_map.branch_bounds, branch_map.branches_lin,
+                                                                branch_map.branch_keys, branch_map.ip_ids)
+    paths = np.stack(np.unravel_index(paths_lin, shape), axis=1).astype(np.int32)
+
     edges = []
-    for ip1_idx, ip in enumerate(ips):
-        if verbose:
-            if ip1_idx%print_interv==0 or ip1_idx==num_points-1:
-                print(f'\rProcessing point {ip1_idx+1} of {num_points}...', end='')
-
-        for branch_idx, branch in enumerate(ip.branches):
-            if branch not in visited_branches:
-                path = track_branch(ip, branch_idx, img_num_neighbors)
-                visited_branches.add(branch)
-                visited_branches.add(path[-1])
-                ip2_idx = branch_map.get_ip_ids(path[-1])
-                if len(ip2_idx)==2:
-                    # If branch is a single point between two bifurcations
-                    if ip2_idx[0]==ip1_idx:
-                        ip2_idx = ip2_idx[1]
-                    else:
-                        ip2_idx = ip2_idx[0]
-                else:
-                    ip2_idx = ip2_idx[0]
-
-                edges.append((ip1_idx, ip2_idx, path))
+    for edge_idx, (ip1_idx, ip2_idx) in enumerate(ip_ids.tolist()):
+        edges.append((ip1_idx, ip2_idx, paths[path_bounds[edge_idx]:path_bounds[edge_idx+1]]))
 
     return edges
 
@@ -454,19 +366,16 @@ def unpad_coords(ips, edges):
         Edges returned by function `track_branches`.
     """
 
-    sub_1 = lambda x:x-1
-
-    #list(map(tuple, pixels_coords))
     for ip in ips:
-        ip.pixels = [tuple(map(sub_1, pixel)) for pixel in ip.pixels]
-        ip.center = tuple(map(sub_1, ip.center))
-        ip.branches = [tuple(map(sub_1, branch)) for branch in ip.branches]
+        ip.pixels_arr -= 1
+        ip.center = tuple(np.subtract(ip.center, 1))
+        ip.branches_arr -= 1
 
     for edge in edges:
         path = edge[2]
-        path[:] = [tuple(map(sub_1, pixel)) for pixel in path]
+        path -= 1
 
-def remove_isolated_points(ips, edges):
+def remove_isolated_points(ips, edges, remove_single_pixel_loops=False):
     """Remove points that have no edge. When doing so, the list of `edges` needs to be updated
     since the indices of the point changed.
 
@@ -476,6 +385,10 @@ def remove_isolated_points(ips, edges):
         List of interest points.
     edges : list of tuple
         Edges returned by function `track_branches`.
+    remove_single_pixel_loops : bool
+        If True, also removes corner case edges representing a single segment pixel between the same
+        point, that is, self-loops with one pixel. Note that points are kept if their only edges are
+        such self-loops.
 
     Returns
     ----------
@@ -485,54 +398,21 @@ def remove_isolated_points(ips, edges):
         Updated list of edges.
     """
 
-    ips_indices = list(range(len(ips)))
-
-    nodes = set([edge[0] for edge in edges] + [edge[1] for edge in edges])
-    nodes_to_remove = set(set(ips_indices) - nodes)
-    new_idx = 0
-    idx_remap = dict(zip(ips_indices, [-1]*len(ips)))  # Will store indices remap
-    for idx in range(len(ips)):
-        if idx in nodes_to_remove:
-            idx_remap[idx] = -1
-        else:
-            idx_remap[idx] = new_idx
-            new_idx += 1
-
-    new_ips = []
-    for node in nodes:
-        new_ips.append(ips[node])
+    ip1_ids = np.array([edge[0] for edge in edges], dtype=np.intp)
+    ip2_ids = np.array([edge[1] for edge in edges], dtype=np.intp)
+    has_edge = np.zeros(len(ips), dtype=bool)
+    has_edge[ip1_ids] = True
+    has_edge[ip2_ids] = True
+    idx_remap = np.cumsum(has_edge) - 1     # New index of each point
 
+    new_ips = [ips[idx] for idx in np.flatnonzero(has_edge)]
     new_edges = []
-    for edge in edges:
-        new_edges.append((idx_remap[edge[0]], idx_remap[edge[1]], edge[2]))
+    for ip1_idx, ip2_idx, edge in zip(idx_remap[ip1_ids].tolist(), idx_remap[ip2_ids].tolist(), edges):
+        if not remove_single_pixel_loops or ip1_idx!=ip2_idx or len(edge[2])>1:
+            new_edges.append((ip1_idx, ip2_idx, edge[2]))
 
     return new_ips, new_edges
 
-def remove_single_pixel_self_edges(edges):
-    """Remove corner case edges representing a single segment pixel between the same point, that is,
-    a self-loop with one pixel.
-
-    Parameters
-    ----------
-    edges : list of tuple
-        Edges, same format as returned by function `track_branches`.
-
-    Returns
-    -------
-    new_edges : list of tuple
-        Updated edges.
-    """
-
-    new_edges = []
-    for edge in edges:
-        if edge[0]!=edge[1]:
-            new_edges.append(edge)
-        else:
-            if len(edge[2])>1:
-                new_edges.append(edge)
-
-    return new_edges
-
 def to_networkx(ips, edges, graph_attrs=None):
     """Converts list of interest points and edges to a networkx MultiGraph.
 
@@ -543,7 +423,7 @@ def to_networkx(ips, edges, graph_attrs=None):
     edges : list of tuple
         Segments between interest points. Each element of the list is a tuple of the form
         (ip1_idx, ip2_idx, path), where ip1_idx and ip2_idx are the indices of the interest points
-        and path a list of pixels between the two points.
+        and path an array of shape (num_pixels, ndim) containing the pixels between the two points.
     graph_attrs : dict
         Graph attributes added to the networkx graph (accessed as graph.graph).
 
@@ -557,13 +437,9 @@ def to_networkx(ips, edges, graph_attrs=None):
         graph_attrs = {}
 
     graph = nx.MultiGraph()
-    for ip_idx, ip in enumerate(ips):
-        ip_dict = {'pixels':ip.pixels, 'center':ip.center, 'type':ip.type, 'ndim':ip.ndim, 'branches':ip.branches}
-        graph.add_node(ip_idx, **ip_dict)
-
-    for edge in edges:
-        edge_dict = {'path':edge[2]}
-        graph.add_edge(edge[0], edge[1], **edge_dict)
+    graph.add_nodes_from((ip_idx, {'pixels':ip.pixels, 'center':ip.center, 'type':ip.type, 'ndim':ip.ndim,
+                                   'branches':ip.branches}) for ip_idx, ip in enumerate(ips))
+    graph.add_edges_from((edge[0], edge[1], {'path':np.array(edge[2], dtype=np.int32)}) for edge in edges)
 
     graph.graph = graph_attrs
 
@@ -588,7 +464,8 @@ def create_graph(img_skel, verbose=False):
 
     Edges in the final graph have the following attributes:
 
-    * 'path': list of pixels associated to the edge. Each pixel has exactly two neighbors in `img_skel`.
+    * 'path': array of shape (num_pixels, ndim) containing the pixels associated to the edge. Each pixel
+    has exactly two neighbors in `img_skel`.
 
     Parameters
     ----------
@@ -603,15 +480,18 @@ def create_graph(img_skel, verbose=False):
         Graph representing the skeleton. Note that the graph may have self-loops and multiple edges.
     """
 
-    if tuple(img_skel.unique()) != (0, 1):
-        raise ValueError('Image must only have values 0 and 1')
-
     img_skel_data = img_skel.data
 
-    if img_skel_data.dtype != np.uint8:
-        img_skel_data = img_skel_data.astype(np.uint8)
+    # For integer images, the range of values is enough for checking if the image is binary
+    is_binary = img_skel_data.min()==0 and img_skel_data.max()==1
+    if is_binary and img_skel_data.dtype.kind not in 'biu':
+        is_binary = np.all((img_skel_data==0) | (img_skel_data==1))
+    if not is_binary:
+        raise ValueError('Image must only have values 0 and 1')
 
-    img_skel_data_pad = np.pad(img_skel_data, 1)
+    # Padded copy of the image. The assignment also converts the values to uint8
+    img_skel_data_pad = np.zeros(tuple(size+2 for size in img_skel_data.shape), dtype=np.uint8)
+    img_skel_data_pad[(slice(1, -1),)*img_skel_data.ndim] = img_skel_data
 
     if img_skel.ndim==2:
         structue = np.ones((3, 3), dtype=np.uint8)
@@ -620,10 +500,22 @@ def create_graph(img_skel, verbose=False):
 
     img_skel_data_pad = util.remove_small_comp(img_skel_data_pad, 2, structure=structue)
 
-    # img_num_neighbors stores the number of neighbors of each pixel. Value -1 is assigned to background pixels
-    img_skel_data_pad = img_skel_data_pad.astype(np.int8)
-    img_num_neighbors = ndi.correlate(img_skel_data_pad, structue)
-    img_num_neighbors = img_num_neighbors*img_skel_data_pad - 1
+    # img_num_neighbors stores the number of neighbors of each pixel. Value -1 is assigned to background pixels.
+    # Due to the padding, the border of img_num_neighbors is background and the neighbors of the skeleton
+    # pixels are always inside the image. Functions that search for neighbors rely on this.
+    # The all-ones structuring element is separable, so the correlation is done along each axis
+    img_skel_data_pad = img_skel_data_pad.view(np.int8)
+    img_num_neighbors = img_skel_data_pad.astype(np.int16)
+    weights = np.ones(3, dtype=np.int16)
+    for axis in range(img_num_neighbors.ndim):
+        ndi.correlate1d(img_num_neighbors, weights, axis=axis, output=img_num_neighbors, mode='constant')
+    # Single masked pass over a buffer filled with the background value. The skeleton only has values
+    # 0 and 1, so it can be viewed as a boolean mask. The values are in the range [-1, 26], so the cast
+    # is safe
+    counts = img_num_neighbors
+    img_num_neighbors = np.full(counts.shape, -1, dtype=np.int8)
+    np.subtract(counts, 1, out=img_num_neighbors, where=img_skel_data_pad.view(bool), casting='unsafe')
+    del counts
 
     # Find interest points
     ips = find_interest_points(img_num_neighbors, verbose)
@@ -632,8 +524,7 @@ def create_graph(img_skel, verbose=False):
 
     edges = track_branches(ips, img_num_neighbors, verbose)
 
-    ips, edges = remove_isolated_points(ips, edges)
-    edges = remove_single_pixel_self_edges(edges)
+    ips, edges = remove_isolated_points(ips, edges, remove_single_pixel_loops=True)
     unpad_coords(ips, edges)
 
     graph_attrs = {'path':img_skel.path, 'pix_size':img_skel.pix_size, 'ndim':img_skel.ndim,
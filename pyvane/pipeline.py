@@ -559,7 +559,7 @@ class DefaultNetworkBuilder(BaseProcessor):
         """
 
         graph = create_graph(img, verbose=(self.verbosity>=3))
-        graph_simple = net_adjust.simplify(graph, False, verbose=(self.verbosity>=3))
+        graph_simple = net_adjust.simplify(graph, verbose=(self.verbosity>=3))
         graph_final = net_adjust.adjust_graph(graph_simple, self.length_threshold, False, True, verbose=(self.verbosity>=3))
 
         return graph_final
@@ -241,7 +241,7 @@ def graph_in_window(graph, win_center, win_size):
 
         pos_node1 = graph.nodes[node1]['center']
         pos_node2 = graph.nodes[node2]['center']
-        pos_edge = graph[node1][node2][key]['path']
+        pos_edge = list(map(tuple, graph[node1][node2][key]['path']))
 
         # Add nodes positions to the edge path. This simplifies the analysis.
         pos_edge_aug = pos_edge
@@ -254,8 +254,8 @@ def expand_values(graph, section_stats_s, img_gray, img_bin):
 
         path = item[2]['path']
         for p,pdata in zip(path, stats_path):
-            img_lvs_skel[p] = pdata['diff_norm_p_mean']
-            img_skel[p] = 1
+            img_lvs_skel[tuple(p)] = pdata['diff_norm_p_mean']
+            img_skel[tuple(p)] = 1
 
     _, (img_inds_r, img_inds_c) = ndi.distance_transform_edt(img_skel==0, return_indices=True)
     img_lvs = img_lvs_skel[img_inds_r, img_inds_c]